@@ -6,7 +6,6 @@ from dify_plugin.entities.tool import ToolInvokeMessage
 
 class DocumentExtractorTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
-        document = tool_parameters["document"].blob()
         yield self.create_json_message({
             "result": "Hello, world!"
         })
\ No newline at end of file
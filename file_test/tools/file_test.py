@@ -4,16 +4,22 @@ from typing import Any
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 from dify_plugin.file.file import File
-import pandas as pd
 import io
+import logging
+
+logger = logging.getLogger(__name__)
 
 class FileTestTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
-        print(tool_parameters)
+        # 延迟导入 pandas，避免拖慢插件启动
+        import pandas as pd
+
         tmp = tool_parameters['query']
-        print(tmp)
-        # print(tmp.blob)
-        print(pd.read_csv(io.BytesIO(tmp.blob)))
+        df = pd.read_csv(io.BytesIO(tmp.blob), engine='pyarrow')
+        # 仅在开启 DEBUG 日志时才格式化参数和 DataFrame
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("tool_parameters: %s, file: %s", tool_parameters, tmp)
+            logger.debug("csv content:\n%s", df)
         yield self.create_json_message({
             "result": "Hello, world!"
         })
@@ -6,37 +6,335 @@ from dify_plugin.entities.tool import ToolInvokeMessage
 
 import os
 import re
+import logging
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
 from typing import List, Optional, Tuple
 from urllib.parse import urljoin, urlparse
-import requests
 from docx import Document
 from docx.shared import Pt, Inches, RGBColor
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT, WD_LINE_SPACING
-from docx.oxml.ns import qn
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+from lxml.etree import XMLSyntaxError
 from io import BytesIO
-from PIL import Image
+from xml.sax.saxutils import escape
+from concurrent.futures import ThreadPoolExecutor
 import traceback
+from copy import deepcopy
+
+logger = logging.getLogger(__name__)
+
+
+# 预编译的正则表达式
+_HEADING_RE = re.compile(r'^(#{1,6})\s+(.+)$')
+_IMG_LINE_RE = re.compile(r'^!\[([^\]]*)\]\(([^\)]+)\)\s*$')
+_IMG_INLINE_RE = re.compile(r'!\[([^\]]*)\]\(([^\)]+)\)')
+_UNORDERED_RE = re.compile(r'^([-*+])\s+(.+)$')
+_ORDERED_RE = re.compile(r'^\d+\.\s+(.+)$')
+# 匹配加粗和斜体的模式，优先级：加粗斜体 > 加粗 > 斜体
+_INLINE_FMT_RE = re.compile(r'(\*\*\*([^*]+)\*\*\*|\*\*([^*]+)\*\*|\*([^*]+)\*|__([^_]+)__|_([^_]+)_)')
+
+# 行类型
+_LINE_BLANK = 0
+_LINE_FENCE = 1
+_LINE_CODE = 2
+_LINE_HEADING = 3
+_LINE_TABLE_ROW = 4
+_LINE_LIST_ITEM = 5
+_LINE_IMAGE = 6
+_LINE_TEXT = 7
+
+# 解析结果中的元素类型
+_ELEM_HEADING = 0
+_ELEM_PARAGRAPH = 1
+_ELEM_CODE = 2
+_ELEM_IMAGE = 3
+_ELEM_TABLE = 4
+_ELEM_LIST = 5
+
+# python-docx 可嵌入的图片格式文件头：PNG、JPEG、GIF、BMP、TIFF
+_IMAGE_SIGNATURES = (
+    b'\x89PNG\r\n\x1a\n',
+    b'\xff\xd8\xff',
+    b'GIF87a',
+    b'GIF89a',
+    b'BM',
+    b'II*\x00',
+    b'MM\x00*',
+)
+
+# 宋体字体设置，复制后插入 run 的 rPr
+_RFONTS_SONG = parse_xml('<w:rFonts %s w:ascii="宋体" w:hAnsi="宋体" w:eastAsia="宋体"/>' % nsdecls('w'))
+
+# 段落模板：1.5 倍行距，正文段落首行缩进 2 字符（28 磅，w:ind 单位为 1/20 磅）
+_HEADING_TEMPLATE = parse_xml(
+    '<w:p %s><w:pPr><w:spacing w:line="360" w:lineRule="auto"/></w:pPr></w:p>' % nsdecls('w')
+)
+_PARAGRAPH_TEMPLATE = parse_xml(
+    '<w:p %s><w:pPr><w:spacing w:line="360" w:lineRule="auto"/><w:ind w:firstLine="560"/></w:pPr></w:p>'
+    % nsdecls('w')
+)
+
+
+def _song_run_template(size: int, bold: bool = False, italic: bool = False):
+    """生成宋体 run 模板（size 单位为半磅）"""
+    return parse_xml(
+        '<w:r %s><w:rPr><w:rFonts w:ascii="宋体" w:hAnsi="宋体" w:eastAsia="宋体"/>%s%s'
+        '<w:sz w:val="%d"/></w:rPr></w:r>'
+        % (nsdecls('w'), '<w:b/>' if bold else '', '<w:i/>' if italic else '', size)
+    )
+
+
+# 正文 run 模板（宋体四号字），按 (加粗, 斜体) 索引
+_RUN_TEMPLATES = {
+    (bold, italic): _song_run_template(28, bold, italic)
+    for bold in (False, True)
+    for italic in (False, True)
+}
+# 标题 run 模板：一级标题三号字，其他四号字，均加粗
+_HEADING_RUN_TEMPLATES = {
+    1: _song_run_template(32, bold=True),
+    2: _song_run_template(28, bold=True),
+}
+
+# 需要转换为 <w:tab/>、<w:br/> 的控制字符
+_RUN_SPECIAL_CHARS = re.compile(r'[\t\r\n]')
+
+
+def _set_run_text(run, text: str):
+    """设置 run 文本：普通文本直接写入单个 <w:t>，避免 python-docx 的逐字符处理"""
+    if _RUN_SPECIAL_CHARS.search(text):
+        run.text = text
+    elif text:
+        run.add_t(text)
+
+
+# 表格单元格 run 模板：宋体四号字（w:sz 单位为半磅，28 即 14 磅）
+_CELL_RUN_XML = (
+    '<w:r><w:rPr><w:rFonts w:ascii="宋体" w:hAnsi="宋体" w:eastAsia="宋体"/>{bold}'
+    '<w:sz w:val="28"/></w:rPr>{text}</w:r>'
+)
+
+
+def _table_row_xml(cells: List[str], widths: List[int], header: bool = False) -> str:
+    """生成表格行 XML，表头加粗居中；单元格多于列数时截断，不足时留空"""
+    ppr = '<w:pPr><w:jc w:val="center"/></w:pPr>' if header else ''
+    bold = '<w:b/>' if header else ''
+    tcs = []
+    for idx, width in enumerate(widths):
+        run = ''
+        if idx < len(cells):
+            text = cells[idx]
+            if text:
+                # 首尾有空白时需要保留空白
+                space = ' xml:space="preserve"' if text != text.strip() else ''
+                text = '<w:t%s>%s</w:t>' % (space, escape(text))
+            run = _CELL_RUN_XML.format(bold=bold, text=text)
+        tcs.append(
+            '<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="%d"/></w:tcPr><w:p>%s%s</w:p></w:tc>'
+            % (width, ppr, run)
+        )
+    return '<w:tr>%s</w:tr>' % ''.join(tcs)
+
+
+# 行内格式片段
+Span = namedtuple('Span', 'text bold italic')
+
+
+def parse_inline_formatting(text: str) -> List[Span]:
+    """
+    解析行内格式（加粗、斜体等）
+    返回格式化的文本片段列表
+    每个片段格式: Span(text, bold, italic)
+    """
+    # 不含强调标记时无需正则扫描
+    if '*' not in text and '_' not in text:
+        return [Span(text, False, False)]
+    return _parse_inline_spans(text)
+
+
+def _parse_inline_spans(text: str) -> List[Span]:
+    """用正则拆分行内格式片段（调用方已确认文本含强调标记）"""
+    parts = []
+    last_pos = 0
+    for match in _INLINE_FMT_RE.finditer(text):
+        # 添加匹配前的普通文本
+        if match.start() > last_pos:
+            parts.append(Span(text[last_pos:match.start()], False, False))
+
+        # 处理匹配的格式
+        full_match = match.group(0)
+        # 加粗斜体: ***text***
+        if full_match.startswith('***') and full_match.endswith('***'):
+            parts.append(Span(match.group(2), True, True))
+        # 加粗: **text** 或 __text__
+        elif full_match.startswith('**') and full_match.endswith('**'):
+            parts.append(Span(match.group(3), True, False))
+        elif full_match.startswith('__') and full_match.endswith('__'):
+            parts.append(Span(match.group(5), True, False))
+        # 斜体: *text* 或 _text_
+        elif full_match.startswith('*') and full_match.endswith('*'):
+            parts.append(Span(match.group(4), False, True))
+        elif full_match.startswith('_') and full_match.endswith('_'):
+            parts.append(Span(match.group(6), False, True))
+
+        last_pos = match.end()
+
+    # 添加剩余的普通文本
+    if last_pos < len(text):
+        parts.append(Span(text[last_pos:], False, False))
+
+    # 如果没有匹配到任何格式，返回原始文本
+    if not parts:
+        parts.append(Span(text, False, False))
+
+    return parts
+
+
+# 全局共享的 HTTP 会话，在首次下载网络图片时创建
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def _get_http_session():
+    """获取共享的 HTTP 会话，复用连接，同一主机的多张图片无需重复建立 TCP/TLS 连接"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            # 延迟导入，插件启动时不加载 requests
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=2)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+    return _http_session
+
+
+class _BytesLRUCache:
+    """线程安全的 LRU 缓存，同时限制条目数和总字节数，过大的值不缓存"""
+
+    def __init__(self, maxsize: int, max_bytes: int, max_entry_bytes: int):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._data: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_entry_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._data[key] = value
+            self._bytes += len(value)
+            # 超出条目数或总字节数时淘汰最久未使用的条目
+            while len(self._data) > self.maxsize or self._bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= len(evicted)
+
+
+# 网络图片缓存：插件内存上限为 256 MiB，按总字节数限制，大图不缓存
+_image_cache = _BytesLRUCache(maxsize=32, max_bytes=32 * 1024 * 1024, max_entry_bytes=4 * 1024 * 1024)
+
+
+def _download_remote_image(url: str) -> bytes:
+    """下载网络图片，按 URL 缓存结果；下载失败时抛出异常，不会被缓存"""
+    data = _image_cache.get(url)
+    if data is not None:
+        return data
+    response = _get_http_session().get(url, timeout=10)
+    response.raise_for_status()
+    data = response.content
+    _image_cache.put(url, data)
+    return data
+
+
+class ParsedDoc:
+    """
+    Markdown 解析结果
+
+    按列存放每个元素的类型、文本和附加数据，避免为每个元素创建一个字典：
+    - 标题：文本为标题内容，附加数据为级别
+    - 段落：文本为段落内容，附加数据为行内格式（可能为 None）
+    - 代码：文本为代码内容，附加数据为语言
+    - 图片：文本为 URL，附加数据为替代文本
+    - 表格：附加数据为 (表头, 数据行)
+    - 列表：附加数据为 (列表类型, 列表项)
+    """
+
+    def __init__(self):
+        self.types: List[int] = []
+        self.texts: List[str] = []
+        self.extras: List[Any] = []
+
+    def _append(self, elem_type: int, text: str, extra: Any):
+        self.types.append(elem_type)
+        self.texts.append(text)
+        self.extras.append(extra)
+
+    def append_heading(self, level: int, text: str):
+        self._append(_ELEM_HEADING, text, level)
+
+    def append_paragraph(self, text: str, formatted_parts: Optional[List[Span]] = None):
+        self._append(_ELEM_PARAGRAPH, text, formatted_parts)
+
+    def append_code(self, text: str, language: str = ''):
+        self._append(_ELEM_CODE, text, language)
+
+    def append_image(self, url: str, alt: str = ''):
+        self._append(_ELEM_IMAGE, url, alt)
+
+    def append_table(self, headers: List[str], rows: List[List[str]]):
+        self._append(_ELEM_TABLE, '', (headers, rows))
+
+    def append_list(self, list_type: str, items: List[dict]):
+        self._append(_ELEM_LIST, '', (list_type, items))
+
+    def image_urls(self) -> List[str]:
+        """返回全部图片 URL（按出现顺序）"""
+        return [text for elem_type, text in zip(self.types, self.texts) if elem_type == _ELEM_IMAGE]
 
 
 class MarkdownParser:
     """解析 Markdown 内容"""
 
     def __init__(self, content: str):
-        self.content = content
-        self.lines = content.split('\n')
+        # 不保留原始内容，只持有拆分后的行；只按 \n 拆分并兼容 \r\n，
+        # 不用 splitlines，避免 U+2028、\f 等字符被当作换行拆开表格单元格或代码
+        self.lines = content.replace('\r\n', '\n').split('\n')
+        self._tags = []
 
     def _is_table_row(self, line: str) -> bool:
         """判断是否是表格行"""
-        return '|' in line and line.strip().startswith('|') or line.count('|') >= 2
+        # 只统计一次 |：两个及以上即为表格行，只有一个时需以 | 开头
+        pipes = line.count('|')
+        if pipes >= 2:
+            return True
+        return pipes == 1 and line.lstrip().startswith('|')
 
     def _is_table_separator(self, line: str) -> bool:
         """判断是否是表格分隔行"""
         stripped = line.strip()
-        if not self._is_table_row(stripped):
+        # 分隔行至少包含一个 -
+        if '-' not in stripped or not self._is_table_row(stripped):
             return False
-        # 分隔行应该只包含 |, -, : 和空格
-        cleaned = stripped.replace('|', '').replace('-', '').replace(':', '').replace(' ', '')
-        return len(cleaned) == 0
+        # 分隔行应该只包含 |, -, : 和空格（两端剥离这些字符后为空即满足）
+        return not stripped.strip('|-: ')
 
     def _parse_table_row(self, line: str) -> List[str]:
         """解析表格行"""
@@ -50,15 +348,16 @@ class MarkdownParser:
         cells = [cell.strip() for cell in line.split('|')]
         return cells
 
-    def _parse_table(self, start_idx: int) -> Tuple[dict, int]:
-        """解析表格，返回表格数据和下一行索引"""
-        table_lines = []
+    def _parse_table(self, start_idx: int) -> Tuple[Optional[Tuple[List[str], List[List[str]]]], int]:
+        """解析表格，返回 (表头, 数据行) 和下一行索引"""
+        tags = self._tags
+        n = len(tags)
         i = start_idx
 
         # 收集所有表格行
-        while i < len(self.lines) and self._is_table_row(self.lines[i]):
-            table_lines.append(self.lines[i])
+        while i < n and tags[i][0] == _LINE_TABLE_ROW:
             i += 1
+        table_lines = self.lines[start_idx:i]
 
         if len(table_lines) < 2:
             # 至少需要表头和分隔行
@@ -72,18 +371,9 @@ class MarkdownParser:
             return None, start_idx + 1
 
         # 解析数据行
-        rows = []
-        for line in table_lines[2:]:
-            if line.strip():
-                rows.append(self._parse_table_row(line))
-
-        table_data = {
-            'type': 'table',
-            'headers': headers,
-            'rows': rows
-        }
+        rows = [self._parse_table_row(line) for line in table_lines[2:] if line.strip()]
 
-        return table_data, i
+        return (headers, rows), i
 
     def _is_list_item(self, line: str) -> Tuple[bool, Optional[str], Optional[str]]:
         """
@@ -93,35 +383,38 @@ class MarkdownParser:
         stripped = line.strip()
 
         # 无序列表: -, *, +
-        unordered_match = re.match(r'^([-*+])\s+(.+)$', stripped)
+        unordered_match = _UNORDERED_RE.match(stripped)
         if unordered_match:
             return True, 'unordered', unordered_match.group(2)
 
         # 有序列表: 1. 2. 等
-        ordered_match = re.match(r'^\d+\.\s+(.+)$', stripped)
+        ordered_match = _ORDERED_RE.match(stripped)
         if ordered_match:
             return True, 'ordered', ordered_match.group(1)
 
         return False, None, None
 
-    def _parse_list(self, start_idx: int) -> Tuple[dict, int]:
-        """解析列表，返回列表数据和下一行索引"""
+    def _parse_list(self, start_idx: int) -> Tuple[Optional[Tuple[str, List[dict]]], int]:
+        """解析列表，返回 (列表类型, 列表项) 和下一行索引"""
         list_items = []
         list_type = None
         i = start_idx
+        # 复用分类时已去除首尾空白的行
+        tags = self._tags
+        n = len(tags)
 
-        while i < len(self.lines):
-            line = self.lines[i]
-            is_list, item_type, content = self._is_list_item(line)
+        while i < n:
+            stripped = tags[i][1]
+            is_list, item_type, content = self._is_list_item(stripped)
 
             if not is_list:
                 # 检查是否是空行（列表可能继续）
-                if not line.strip():
+                if not stripped:
                     # 如果下一行也是空行或不是列表，则结束列表
-                    if i + 1 >= len(self.lines) or not self.lines[i + 1].strip():
+                    if i + 1 >= n or not tags[i + 1][1]:
                         break
                     # 检查下一行是否是列表
-                    next_is_list, _, _ = self._is_list_item(self.lines[i + 1])
+                    next_is_list, _, _ = self._is_list_item(tags[i + 1][1])
                     if not next_is_list:
                         break
                     i += 1
@@ -147,229 +440,160 @@ class MarkdownParser:
         if not list_items:
             return None, start_idx + 1
 
-        list_data = {
-            'type': 'list',
-            'list_type': list_type,
-            'items': list_items
-        }
-
-        return list_data, i
-
-    def _parse_inline_formatting(self, text: str) -> List[dict]:
-        """
-        解析行内格式（加粗、斜体等）
-        返回格式化的文本片段列表
-        每个片段格式: {'text': str, 'bold': bool, 'italic': bool}
-        """
-        parts = []
-        # 匹配加粗和斜体的模式
-        # 优先级：加粗 > 斜体
-        pattern = r'(\*\*\*([^*]+)\*\*\*|\*\*([^*]+)\*\*|\*([^*]+)\*|__([^_]+)__|_([^_]+)_)'
-
-        last_pos = 0
-        for match in re.finditer(pattern, text):
-            # 添加匹配前的普通文本
-            if match.start() > last_pos:
-                parts.append({
-                    'text': text[last_pos:match.start()],
-                    'bold': False,
-                    'italic': False
-                })
-
-            # 处理匹配的格式
-            full_match = match.group(0)
-            # 加粗斜体: ***text***
-            if full_match.startswith('***') and full_match.endswith('***'):
-                content = match.group(2)
-                parts.append({
-                    'text': content,
-                    'bold': True,
-                    'italic': True
-                })
-            # 加粗: **text** 或 __text__
-            elif full_match.startswith('**') and full_match.endswith('**'):
-                content = match.group(3)
-                parts.append({
-                    'text': content,
-                    'bold': True,
-                    'italic': False
-                })
-            elif full_match.startswith('__') and full_match.endswith('__'):
-                content = match.group(5)
-                parts.append({
-                    'text': content,
-                    'bold': True,
-                    'italic': False
-                })
-            # 斜体: *text* 或 _text_
-            elif full_match.startswith('*') and full_match.endswith('*'):
-                content = match.group(4)
-                parts.append({
-                    'text': content,
-                    'bold': False,
-                    'italic': True
-                })
-            elif full_match.startswith('_') and full_match.endswith('_'):
-                content = match.group(6)
-                parts.append({
-                    'text': content,
-                    'bold': False,
-                    'italic': True
-                })
+        return (list_type, list_items), i
 
-            last_pos = match.end()
+    @staticmethod
+    def _inline_parts(text: str) -> Optional[List[Span]]:
+        """解析段落的行内格式；不含强调标记时返回 None，按普通文本输出"""
+        if '*' not in text and '_' not in text:
+            return None
+        return _parse_inline_spans(text)
+
+    def _classify_line(self, line: str, stripped: str, allow_table: bool = True) -> Tuple[int, Optional[re.Match]]:
+        """判断非空、非代码块行的类型，返回 (行类型, 匹配结果)"""
+        # 先看首字符，普通文本行无需逐个尝试正则
+        first = line[0]
+        if first == '#':
+            heading_match = _HEADING_RE.match(line)
+            if heading_match:
+                return _LINE_HEADING, heading_match
+
+        if allow_table and self._is_table_row(stripped):
+            return _LINE_TABLE_ROW, None
+
+        lead = stripped[0]
+        if lead in '-*+':
+            list_match = _UNORDERED_RE.match(stripped)
+            if list_match:
+                return _LINE_LIST_ITEM, list_match
+        elif lead.isdigit():
+            list_match = _ORDERED_RE.match(stripped)
+            if list_match:
+                return _LINE_LIST_ITEM, list_match
+
+        if first == '!':
+            img_match = _IMG_LINE_RE.match(line)
+            if img_match:
+                return _LINE_IMAGE, img_match
 
-        # 添加剩余的普通文本
-        if last_pos < len(text):
-            parts.append({
-                'text': text[last_pos:],
-                'bold': False,
-                'italic': False
-            })
+        return _LINE_TEXT, None
 
-        # 如果没有匹配到任何格式，返回原始文本
-        if not parts:
-            parts.append({
-                'text': text,
-                'bold': False,
-                'italic': False
-            })
+    def _classify_lines(self) -> List[Tuple[int, str, Optional[re.Match]]]:
+        """逐行扫描一次，返回每行的 (行类型, 去除首尾空白后的行, 匹配结果)"""
+        tags = []
+        in_code_block = False
+        # 循环内使用局部变量，避免每行重复查找属性
+        append = tags.append
+        classify_line = self._classify_line
+
+        for line in self.lines:
+            stripped = line.strip()
+            if stripped.startswith('```'):
+                in_code_block = not in_code_block
+                append((_LINE_FENCE, stripped, None))
+            elif in_code_block:
+                append((_LINE_CODE, stripped, None))
+            elif not stripped:
+                append((_LINE_BLANK, stripped, None))
+            else:
+                kind, match = classify_line(line, stripped)
+                append((kind, stripped, match))
 
-        return parts
+        return tags
 
-    def parse(self) -> List[dict]:
+    def parse(self) -> ParsedDoc:
         """解析 Markdown 内容为结构化数据"""
-        elements = []
+        doc = ParsedDoc()
+        lines = self.lines
+        tags = self._tags = self._classify_lines()
+        n = len(tags)
         i = 0
         in_code_block = False
         code_lines = []
         code_lang = ''
 
-        while i < len(self.lines):
-            line = self.lines[i]
+        while i < n:
+            kind, stripped, match = tags[i]
 
             # 处理代码块
-            if line.strip().startswith('```'):
+            if kind == _LINE_FENCE:
                 if not in_code_block:
                     in_code_block = True
-                    code_lang = line.strip()[3:].strip()
+                    code_lang = stripped[3:].strip()
                     code_lines = []
                 else:
                     in_code_block = False
-                    elements.append({
-                        'type': 'code',
-                        'content': '\n'.join(code_lines),
-                        'language': code_lang
-                    })
+                    doc.append_code('\n'.join(code_lines), code_lang)
                     code_lines = []
                     code_lang = ''
                 i += 1
                 continue
 
-            if in_code_block:
-                code_lines.append(line)
+            if kind == _LINE_CODE:
+                code_lines.append(lines[i])
+                i += 1
+                continue
+
+            # 处理空行
+            if kind == _LINE_BLANK:
                 i += 1
                 continue
 
             # 处理标题
-            heading_match = re.match(r'^(#{1,6})\s+(.+)$', line)
-            if heading_match:
-                level = len(heading_match.group(1))
-                text = heading_match.group(2).strip()
-                elements.append({
-                    'type': 'heading',
-                    'level': level,
-                    'content': text
-                })
+            if kind == _LINE_HEADING:
+                doc.append_heading(len(match.group(1)), match.group(2).strip())
                 i += 1
                 continue
 
             # 处理表格
-            if self._is_table_row(line):
+            if kind == _LINE_TABLE_ROW:
                 table_data, next_i = self._parse_table(i)
                 if table_data:
-                    elements.append(table_data)
+                    doc.append_table(*table_data)
                     i = next_i
                     continue
+                # 不构成表格时按其他类型处理
+                kind, match = self._classify_line(lines[i], stripped, allow_table=False)
 
             # 处理列表
-            is_list, _, _ = self._is_list_item(line)
-            if is_list:
+            if kind == _LINE_LIST_ITEM:
                 list_data, next_i = self._parse_list(i)
                 if list_data:
-                    elements.append(list_data)
+                    doc.append_list(*list_data)
                     i = next_i
                     continue
 
             # 处理独立的图片
-            img_match = re.match(r'^!\[([^\]]*)\]\(([^\)]+)\)\s*$', line)
-            if img_match:
-                alt_text = img_match.group(1)
-                img_url = img_match.group(2)
-                elements.append({
-                    'type': 'image',
-                    'alt': alt_text,
-                    'url': img_url
-                })
+            if kind == _LINE_IMAGE:
+                doc.append_image(match.group(2), match.group(1))
                 i += 1
                 continue
 
-            # 处理空行
-            if not line.strip():
-                i += 1
-                continue
-
-            # 处理普通段落（可能包含行内图片和格式）
-            paragraph_lines = []
-            while i < len(self.lines) and self.lines[i].strip():
-                if self.lines[i].startswith('#') or self.lines[i].strip().startswith('```'):
-                    break
-                # 检查是否是表格行
-                if self._is_table_row(self.lines[i]):
-                    break
-                # 检查是否是列表项
-                is_list_item, _, _ = self._is_list_item(self.lines[i])
-                if is_list_item:
-                    break
-                # 检查是否是独立图片行
-                if re.match(r'^!\[([^\]]*)\]\(([^\)]+)\)\s*$', self.lines[i]):
-                    break
-                paragraph_lines.append(self.lines[i])
+            # 处理普通段落（可能包含行内图片和格式），连续的普通文本行合并为一段
+            start = i
+            i += 1
+            while i < n and tags[i][0] == _LINE_TEXT and not lines[i].startswith('#'):
                 i += 1
 
-            if paragraph_lines:
-                paragraph_text = ' '.join(paragraph_lines)
-                # 检查段落中是否包含图片
-                img_pattern = r'!\[([^\]]*)\]\(([^\)]+)\)'
-                if re.search(img_pattern, paragraph_text):
-                    # 拆分文本和图片
-                    parts = re.split(img_pattern, paragraph_text)
-                    for idx, part in enumerate(parts):
-                        if idx % 3 == 0 and part.strip():  # 文本部分
-                            # 解析行内格式
-                            formatted_parts = self._parse_inline_formatting(part.strip())
-                            elements.append({
-                                'type': 'paragraph',
-                                'content': part.strip(),
-                                'formatted_parts': formatted_parts
-                            })
-                        elif idx % 3 == 2:  # 图片 URL
-                            alt_text = parts[idx - 1]
-                            elements.append({
-                                'type': 'image',
-                                'alt': alt_text,
-                                'url': part
-                            })
-                else:
-                    # 解析行内格式
-                    formatted_parts = self._parse_inline_formatting(paragraph_text)
-                    elements.append({
-                        'type': 'paragraph',
-                        'content': paragraph_text,
-                        'formatted_parts': formatted_parts
-                    })
+            paragraph_text = ' '.join(lines[start:i])
+            # 检查段落中是否包含图片
+            if _IMG_INLINE_RE.search(paragraph_text):
+                # 按顺序输出图片前的文本和图片本身
+                last_end = 0
+                for m in _IMG_INLINE_RE.finditer(paragraph_text):
+                    text = paragraph_text[last_end:m.start()].strip()
+                    if text:
+                        doc.append_paragraph(text, self._inline_parts(text))
+                    doc.append_image(m.group(2), m.group(1))
+                    last_end = m.end()
+                # 最后一张图片之后的文本
+                text = paragraph_text[last_end:].strip()
+                if text:
+                    doc.append_paragraph(text, self._inline_parts(text))
+            else:
+                doc.append_paragraph(paragraph_text, self._inline_parts(paragraph_text))
 
-        return elements
+        return doc
 
 
 class DocxConverter:
@@ -378,6 +602,12 @@ class DocxConverter:
     # 字号定义（磅值）
     FONT_SIZE_3 = Pt(16)  # 三号字
     FONT_SIZE_4 = Pt(14)  # 四号字
+    CODE_FONT_SIZE = Pt(10)  # 代码字号
+    CAPTION_FONT_SIZE = Pt(10)  # 图片说明字号
+    CODE_INDENT = Pt(14)  # 代码块左右缩进
+
+    # 并发下载图片的最大线程数
+    MAX_DOWNLOAD_WORKERS = 8
 
     def __init__(self, base_url: Optional[str] = None, image_width: float = 5.0):
         """
@@ -390,53 +620,44 @@ class DocxConverter:
         self.document = Document()
         self.base_url = base_url
         self.image_width = image_width
+        # 图片宽度只换算一次
+        self._image_width_length = Inches(image_width)
+        # 预取的图片内容：url -> bytes（下载失败为 None）
+        self._prefetched_images = {}
+        # 是否有图片因下载或插入失败而改用替代文本（此类结果不应缓存）
+        self.had_image_failure = False
 
     def set_song_font(self, run):
-        """设置宋体字体"""
-        run.font.name = '宋体'
-        # 设置中文字体
-        run._element.rPr.rFonts.set(qn('w:eastAsia'), '宋体')
+        """设置宋体字体（西文和中文字体均为宋体）"""
+        rPr = run._r.get_or_add_rPr()
+        rPr._remove_rFonts()
+        rPr._insert_rFonts(deepcopy(_RFONTS_SONG))
+
+    def _append_paragraph(self, template, runs):
+        """复制段落模板，按 (run 模板, 文本) 依次添加 run，并追加到文档正文"""
+        paragraph = deepcopy(template)
+        for run_template, text in runs:
+            run = deepcopy(run_template)
+            _set_run_text(run, text)
+            paragraph.append(run)
+        self.document.element.body._insert_p(paragraph)
 
     def add_heading(self, text: str, level: int):
         """添加标题"""
-        paragraph = self.document.add_paragraph()
-        run = paragraph.add_run(text)
-
         # 一级标题使用三号字，其他使用四号字
-        if level == 1:
-            run.font.size = self.FONT_SIZE_3
-        else:
-            run.font.size = self.FONT_SIZE_4
-
-        run.font.bold = True
-        self.set_song_font(run)
+        run_template = _HEADING_RUN_TEMPLATES[1 if level == 1 else 2]
+        self._append_paragraph(_HEADING_TEMPLATE, [(run_template, text)])
 
-        # 设置行间距
-        paragraph.paragraph_format.line_spacing_rule = WD_LINE_SPACING.ONE_POINT_FIVE
-
-    def add_paragraph(self, text: str, formatted_parts: Optional[List[dict]] = None):
+    def add_paragraph(self, text: str, formatted_parts: Optional[List[Span]] = None):
         """添加段落"""
-        paragraph = self.document.add_paragraph()
-
         # 如果有格式化的部分，使用格式化文本
         if formatted_parts:
-            for part in formatted_parts:
-                run = paragraph.add_run(part['text'])
-                run.font.size = self.FONT_SIZE_4
-                self.set_song_font(run)
-                if part.get('bold'):
-                    run.font.bold = True
-                if part.get('italic'):
-                    run.font.italic = True
+            runs = [(_RUN_TEMPLATES[bold, italic], part_text)
+                    for part_text, bold, italic in formatted_parts]
         else:
             # 普通文本
-            run = paragraph.add_run(text)
-            run.font.size = self.FONT_SIZE_4
-            self.set_song_font(run)
-
-        # 设置段落格式
-        paragraph.paragraph_format.first_line_indent = Pt(28)  # 2字符缩进（约28磅）
-        paragraph.paragraph_format.line_spacing_rule = WD_LINE_SPACING.ONE_POINT_FIVE
+            runs = [(_RUN_TEMPLATES[False, False], text)]
+        self._append_paragraph(_PARAGRAPH_TEMPLATE, runs)
 
     def add_code(self, code_text: str, language: str = ''):
         """添加代码块"""
@@ -445,23 +666,50 @@ class DocxConverter:
 
         # 代码使用等宽字体，较小字号
         run.font.name = 'Consolas'
-        run.font.size = Pt(10)
+        run.font.size = self.CODE_FONT_SIZE
 
         # 设置背景色（浅灰色）
-        paragraph.paragraph_format.left_indent = Pt(14)
-        paragraph.paragraph_format.right_indent = Pt(14)
+        paragraph.paragraph_format.left_indent = self.CODE_INDENT
+        paragraph.paragraph_format.right_indent = self.CODE_INDENT
+
+    def prefetch_images(self, urls: List[str]):
+        """并发预下载图片，避免逐张串行等待网络"""
+        pending = [url for url in dict.fromkeys(urls) if url not in self._prefetched_images]
+        if not pending:
+            return
+
+        if len(pending) == 1:
+            # 只有一张图片时直接下载，无需创建线程池
+            results = [self._fetch_image(pending[0])]
+        else:
+            max_workers = min(self.MAX_DOWNLOAD_WORKERS, len(pending))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(self._fetch_image, pending))
+
+        for url, image_data in zip(pending, results):
+            self._prefetched_images[url] = image_data.getvalue() if image_data else None
 
     def download_image(self, url: str) -> Optional[BytesIO]:
-        """下载图片"""
+        """下载图片（优先使用预取结果）"""
+        if url in self._prefetched_images:
+            data = self._prefetched_images[url]
+            return BytesIO(data) if data is not None else None
+        return self._fetch_image(url)
+
+    def _fetch_image(self, url: str) -> Optional[BytesIO]:
+        """从本地或网络读取图片"""
         try:
+            parsed = urlparse(url)
             # 处理相对路径
-            if self.base_url and not urlparse(url).scheme:
+            if self.base_url and not parsed.scheme:
                 url = urljoin(self.base_url, url)
+                parsed = urlparse(url)
 
             # 如果是本地文件路径
-            if not urlparse(url).scheme or urlparse(url).scheme == 'file':
-                # 去除 file:// 前缀
-                local_path = url.replace('file://', '')
+            scheme = parsed.scheme
+            if not scheme or scheme == 'file':
+                # file:// 地址取其路径部分
+                local_path = parsed.path if scheme == 'file' else url
                 if os.path.exists(local_path):
                     with open(local_path, 'rb') as f:
                         return BytesIO(f.read())
@@ -470,9 +718,7 @@ class DocxConverter:
                     return None
 
             # 下载网络图片
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            return BytesIO(response.content)
+            return BytesIO(_download_remote_image(url))
 
         except Exception as e:
             print(f"警告: 无法下载图片 {url}: {str(e)}")
@@ -484,22 +730,21 @@ class DocxConverter:
 
         if image_data:
             try:
-                # 验证图片
-                img = Image.open(image_data)
-                img.verify()
-                image_data.seek(0)  # 重置指针
+                # 只检查文件头验证图片格式，无需完整解码
+                if not image_data.getvalue()[:8].startswith(_IMAGE_SIGNATURES):
+                    raise ValueError("不支持的图片格式")
 
                 # 添加图片到文档
                 paragraph = self.document.add_paragraph()
                 paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
                 run = paragraph.add_run()
-                run.add_picture(image_data, width=Inches(self.image_width))
+                run.add_picture(image_data, width=self._image_width_length)
 
                 # 如果有描述文字，添加图注
                 if alt_text:
                     caption = self.document.add_paragraph()
                     caption_run = caption.add_run(f"图: {alt_text}")
-                    caption_run.font.size = Pt(10)
+                    caption_run.font.size = self.CAPTION_FONT_SIZE
                     self.set_song_font(caption_run)
                     caption.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
 
@@ -507,46 +752,27 @@ class DocxConverter:
                 print(traceback.format_exc())
                 print(f"警告: 无法插入图片 {url}: {str(e)}")
                 # 添加替代文本
+                self.had_image_failure = True
                 self.add_paragraph(f"[图片: {alt_text or url}]")
         else:
             # 图片下载失败，添加替代文本
+            self.had_image_failure = True
             self.add_paragraph(f"[图片: {alt_text or url}]")
 
     def add_table(self, headers: List[str], rows: List[List[str]]):
         """添加表格"""
-        # 创建表格（行数 = 表头1行 + 数据行）
-        table = self.document.add_table(rows=1 + len(rows), cols=len(headers))
+        # 只创建不含行的表格（列宽、样式由 python-docx 生成）
+        table = self.document.add_table(rows=0, cols=len(headers))
 
         # 设置表格样式
         table.style = 'Light Grid Accent 1'
 
-        # 填充表头
-        header_cells = table.rows[0].cells
-        for idx, header_text in enumerate(headers):
-            cell = header_cells[idx]
-            paragraph = cell.paragraphs[0]
-            run = paragraph.add_run(header_text)
-
-            # 设置表头格式：宋体四号字，加粗
-            run.font.size = self.FONT_SIZE_4
-            run.font.bold = True
-            self.set_song_font(run)
-
-            # 表头居中
-            paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-
-        # 填充数据行
-        for row_idx, row_data in enumerate(rows):
-            row_cells = table.rows[row_idx + 1].cells
-            for col_idx, cell_text in enumerate(row_data):
-                if col_idx < len(row_cells):  # 防止列数不匹配
-                    cell = row_cells[col_idx]
-                    paragraph = cell.paragraphs[0]
-                    run = paragraph.add_run(cell_text)
-
-                    # 设置单元格格式：宋体四号字
-                    run.font.size = self.FONT_SIZE_4
-                    self.set_song_font(run)
+        # 表头和数据行（宋体四号字）拼成一段 XML，一次解析后整体追加
+        widths = [grid_col.w.twips for grid_col in table._tbl.tblGrid.gridCol_lst]
+        rows_xml = [_table_row_xml(headers, widths, header=True)]
+        rows_xml.extend(_table_row_xml(row_data, widths) for row_data in rows)
+        container = parse_xml('<w:tbl %s>%s</w:tbl>' % (nsdecls('w'), ''.join(rows_xml)))
+        table._tbl.extend(list(container))
 
         # 在表格后添加一个空段落，避免格式问题
         self.document.add_paragraph()
@@ -562,7 +788,7 @@ class DocxConverter:
 
             # 解析列表项中的行内格式
             content = item.get('content', '')
-            formatted_parts = self._parse_inline_formatting(content)
+            formatted_parts = parse_inline_formatting(content)
 
             # 清除默认创建的 run（如果有）
             if paragraph.runs:
@@ -570,14 +796,14 @@ class DocxConverter:
                     run.text = ''
 
             # 添加格式化的文本
-            for part in formatted_parts:
-                if part['text']:  # 只添加非空文本
-                    run = paragraph.add_run(part['text'])
+            for part_text, bold, italic in formatted_parts:
+                if part_text:  # 只添加非空文本
+                    run = paragraph.add_run(part_text)
                     run.font.size = self.FONT_SIZE_4
                     self.set_song_font(run)
-                    if part.get('bold'):
+                    if bold:
                         run.font.bold = True
-                    if part.get('italic'):
+                    if italic:
                         run.font.italic = True
 
             # 设置行间距
@@ -586,105 +812,25 @@ class DocxConverter:
         # 在列表后添加一个空段落，避免格式问题
         self.document.add_paragraph()
 
-    def _parse_inline_formatting(self, text: str) -> List[dict]:
-        """
-        解析行内格式（加粗、斜体等）
-        返回格式化的文本片段列表
-        """
-        parts = []
-        # 匹配加粗和斜体的模式
-        # 优先级：加粗斜体 > 加粗 > 斜体
-        pattern = r'(\*\*\*([^*]+)\*\*\*|\*\*([^*]+)\*\*|\*([^*]+)\*|__([^_]+)__|_([^_]+)_)'
-
-        last_pos = 0
-        for match in re.finditer(pattern, text):
-            # 添加匹配前的普通文本
-            if match.start() > last_pos:
-                parts.append({
-                    'text': text[last_pos:match.start()],
-                    'bold': False,
-                    'italic': False
-                })
-
-            # 处理匹配的格式
-            full_match = match.group(0)
-            # 加粗斜体: ***text***
-            if full_match.startswith('***') and full_match.endswith('***'):
-                content = match.group(2)
-                parts.append({
-                    'text': content,
-                    'bold': True,
-                    'italic': True
-                })
-            # 加粗: **text** 或 __text__
-            elif full_match.startswith('**') and full_match.endswith('**'):
-                content = match.group(3)
-                parts.append({
-                    'text': content,
-                    'bold': True,
-                    'italic': False
-                })
-            elif full_match.startswith('__') and full_match.endswith('__'):
-                content = match.group(5)
-                parts.append({
-                    'text': content,
-                    'bold': True,
-                    'italic': False
-                })
-            # 斜体: *text* 或 _text_
-            elif full_match.startswith('*') and full_match.endswith('*'):
-                content = match.group(4)
-                parts.append({
-                    'text': content,
-                    'bold': False,
-                    'italic': True
-                })
-            elif full_match.startswith('_') and full_match.endswith('_'):
-                content = match.group(6)
-                parts.append({
-                    'text': content,
-                    'bold': False,
-                    'italic': True
-                })
-
-            last_pos = match.end()
-
-        # 添加剩余的普通文本
-        if last_pos < len(text):
-            parts.append({
-                'text': text[last_pos:],
-                'bold': False,
-                'italic': False
-            })
-
-        # 如果没有匹配到任何格式，返回原始文本
-        if not parts:
-            parts.append({
-                'text': text,
-                'bold': False,
-                'italic': False
-            })
-
-        return parts
-
-    def convert(self, elements: List[dict]) -> Document:
-        """转换元素列表为 DOCX 文档"""
-        for element in elements:
-            element_type = element.get('type')
-
-            if element_type == 'heading':
-                self.add_heading(element['content'], element['level'])
-            elif element_type == 'paragraph':
-                formatted_parts = element.get('formatted_parts')
-                self.add_paragraph(element['content'], formatted_parts)
-            elif element_type == 'code':
-                self.add_code(element['content'], element.get('language', ''))
-            elif element_type == 'image':
-                self.add_image(element['url'], element.get('alt', ''))
-            elif element_type == 'table':
-                self.add_table(element['headers'], element['rows'])
-            elif element_type == 'list':
-                self.add_list(element['list_type'], element['items'])
+    def convert(self, doc: ParsedDoc) -> Document:
+        """转换解析结果为 DOCX 文档"""
+        # 先并发下载全部图片
+        self.prefetch_images(doc.image_urls())
+
+        # 按元素类型分派到对应的处理方法（段落最常见，放在最前）
+        for elem_type, text, extra in zip(doc.types, doc.texts, doc.extras):
+            if elem_type == _ELEM_PARAGRAPH:
+                self.add_paragraph(text, extra)
+            elif elem_type == _ELEM_HEADING:
+                self.add_heading(text, extra)
+            elif elem_type == _ELEM_CODE:
+                self.add_code(text, extra)
+            elif elem_type == _ELEM_IMAGE:
+                self.add_image(text, extra)
+            elif elem_type == _ELEM_TABLE:
+                self.add_table(*extra)
+            elif elem_type == _ELEM_LIST:
+                self.add_list(*extra)
 
         return self.document
 
@@ -693,7 +839,24 @@ class DocxConverter:
         self.document.save(output_path)
 
 
+# 渲染结果缓存：相同内容和图片宽度直接复用已生成的 DOCX
+# 插件内存上限为 256 MiB，除条目数外还限制缓存总字节数，过大的文档不缓存
+_docx_cache = _BytesLRUCache(maxsize=64, max_bytes=32 * 1024 * 1024, max_entry_bytes=8 * 1024 * 1024)
+
+
+def _docx_cache_key(md_content: str, image_width: float) -> str:
+    """计算缓存键（内容摘要 + 图片宽度）"""
+    digest = hashlib.blake2b(md_content.encode('utf-8'), digest_size=16)
+    digest.update(repr(float(image_width)).encode('ascii'))
+    return digest.hexdigest()
+
+
 def convert_md_to_docx(md_content: str, image_width: float = 5.0):
+    cache_key = _docx_cache_key(md_content, image_width)
+    cached = _docx_cache.get(cache_key)
+    if cached is not None:
+        return 1, cached
+
     try:
         # 解析 Markdown
         parser = MarkdownParser(md_content)
@@ -706,10 +869,23 @@ def convert_md_to_docx(md_content: str, image_width: float = 5.0):
         # 将Document对象保存到字节流
         output_stream = BytesIO()
         document.save(output_stream)
-        output_stream.seek(0)
-        return 1, output_stream.getvalue()
-    except Exception as e:
+        # getvalue() 直接移交内部缓冲区（无其他引用时不复制），
+        # 随后释放流对象，避免同时持有两份文档数据
+        file_bytes = output_stream.getvalue()
+        output_stream.close()
+
+        # 有图片改用替代文本时不缓存，图片恢复后可重新生成
+        if not converter.had_image_failure:
+            _docx_cache.put(cache_key, file_bytes)
+        return 1, file_bytes
+    except (OSError, ValueError, XMLSyntaxError):
+        # 读写文档数据失败（如图片或输出流异常、文本含 XML 不允许的字符），返回失败状态
+        logger.warning("Markdown 转换 DOCX 失败", exc_info=True)
         return 0, None
+    except Exception:
+        # 其他异常多为代码问题，记录后继续抛出，避免被掩盖
+        logger.exception("Markdown 转换 DOCX 时发生未预期的错误")
+        raise
 
 
 class Md2docxTool(Tool):
@@ -733,4 +909,4 @@ class Md2docxTool(Tool):
                 }
             )
         else:
-            yield self.create_text_message("Error converting markdown to DOCX")
+            yield self.create_text_message("Error converting markdown to DOCX: failed to read or write document data")
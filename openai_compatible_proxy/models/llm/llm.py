@@ -1,9 +1,12 @@
+import atexit
 import json
 import logging
+import threading
 from abc import ABC
 from collections.abc import Generator
 from decimal import Decimal
-from typing import Optional, Union, cast, Any
+from functools import lru_cache
+from typing import Optional, Union, Any
 
 import httpx
 from dify_plugin import LargeLanguageModel
@@ -31,69 +34,179 @@ from openai.types.chat import ChatCompletion
 
 logger = logging.getLogger(__name__)
 
+# 复用同一个编码器：json.dumps 传入非默认参数时每次调用都会新建 JSONEncoder
+_REFERENCE_ENCODER = json.JSONEncoder(ensure_ascii=False)
 
-def _to_credential_kwargs(credentials: dict) -> dict:
+
+def _client_key(credentials: dict) -> tuple[str, str, Optional[str]]:
+    """提取创建客户端所需的凭据：(api_key, base_url, 代理地址)，未启用代理时代理地址为 None"""
+    proxy_host = None
     if credentials.get("proxy"):
-        credentials_kwargs = {
-            'api_key': credentials['openai_api_key'],
-            'max_retries': 1,
-            'base_url': credentials['openai_api_base'],
-            'http_client': httpx.Client(
-                proxy=credentials.get('proxy_host', "http://squid02.aiapsuat.suningbank.com:18888"), verify=False, )
-        }
-    else:
-        credentials_kwargs = {
-            'api_key': credentials['openai_api_key'],
-            'max_retries': 1,
-            'base_url': credentials['openai_api_base']
-        }
-    return credentials_kwargs
+        proxy_host = credentials.get('proxy_host', "http://squid02.aiapsuat.suningbank.com:18888")
+    return credentials['openai_api_key'], credentials['openai_api_base'], proxy_host
 
 
-def _convert_prompt_message_to_dict(message: PromptMessage) -> dict:
-    if isinstance(message, UserPromptMessage):
-        message_dict = {"role": "user", "content": message.content}
-    elif isinstance(message, list):
-        sub_messages = []
-        for message_content in message.content:
-            if isinstance(message_content, TextPromptMessageContent):
-                sub_message_dict = {
-                    "type": "text",
-                    "text": message_content.data
-                }
-                sub_messages.append(sub_message_dict)
-            elif isinstance(message_content, ImagePromptMessageContent):
-                sub_message_dict = {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": message_content.data,
-                        "detail": message_content.detail.value,
-                    }
-                }
-                sub_messages.append(sub_message_dict)
-            else:
-                # 暂时不会出现其他模态的数据
-                pass
-        message_dict = {"role": "user", "content": sub_messages}
-    elif isinstance(message, AssistantPromptMessage):
-        message = cast(AssistantPromptMessage, message)
-        message_dict = {"role": "assistant", "content": message.content}
-    elif isinstance(message, SystemPromptMessage):
-        message = cast(SystemPromptMessage, message)
-        if isinstance(message.content, list):
-            text_contents = filter(
-                lambda c: isinstance(c, TextPromptMessageContent), message.content
+# 按代理地址共享的 httpx 客户端，进程退出时统一关闭
+_proxy_http_clients: dict[str, httpx.Client] = {}
+_proxy_http_clients_lock = threading.Lock()
+
+
+def _get_proxy_http_client(proxy_host: str) -> httpx.Client:
+    """每个代理地址共用一个 httpx 客户端及其连接池（支持 HTTP/2 多路复用）"""
+    with _proxy_http_clients_lock:
+        client = _proxy_http_clients.get(proxy_host)
+        if client is None:
+            client = httpx.Client(
+                proxy=proxy_host,
+                verify=False,
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60),
             )
-            message.content = "".join(c.data for c in text_contents)
-        message_dict = {"role": "system", "content": message.content}
-    elif isinstance(message, ToolPromptMessage):
-        message = cast(ToolPromptMessage, message)
-        message_dict = {"role": "function", "content": message.content, "name": message.tool_call_id}
-    else:
-        # print(message.content)
-        # print(message)
-        raise ValueError(f"Got unknown type {message}")
+            _proxy_http_clients[proxy_host] = client
+        return client
+
+
+@atexit.register
+def _close_proxy_http_clients():
+    """关闭共享的 httpx 客户端，释放连接"""
+    with _proxy_http_clients_lock:
+        clients = list(_proxy_http_clients.values())
+        _proxy_http_clients.clear()
+    for client in clients:
+        client.close()
+
+
+@lru_cache(maxsize=128)
+def _get_client(api_key: str, base_url: str, proxy_host: Optional[str]) -> OpenAI:
+    """按凭据复用 OpenAI 客户端，避免每次请求都重新建立连接池和 TLS 握手"""
+    credentials_kwargs = {
+        'api_key': api_key,
+        'max_retries': 1,
+        'base_url': base_url
+    }
+    if proxy_host:
+        credentials_kwargs['http_client'] = _get_proxy_http_client(proxy_host)
+    return OpenAI(**credentials_kwargs)
+
+
+# 自定义模型的参数规则模板（默认值在 get_customizable_model_schema 中按凭据填充）
+_TEMPERATURE_RULE = ParameterRule(
+    name=DefaultParameterName.TEMPERATURE.value,
+    label=I18nObject(en_US="Temperature", zh_Hans="温度"),
+    help=I18nObject(
+        en_US="Kernel sampling threshold. Used to determine the randomness of the results."
+              "The higher the value, the stronger the randomness."
+              "The higher the possibility of getting different answers to the same question.",
+        zh_Hans="核采样阈值。用于决定结果随机性，取值越高随机性越强即相同的问题得到的不同答案的可能性越高。",
+    ),
+    type=ParameterType.FLOAT,
+    default=0.7,
+    min=0,
+    max=2,
+    precision=2,
+)
+_TOP_P_RULE = ParameterRule(
+    name=DefaultParameterName.TOP_P.value,
+    label=I18nObject(en_US="Top P", zh_Hans="Top P"),
+    help=I18nObject(
+        en_US="The probability threshold of the nucleus sampling method during the generation process."
+              "The larger the value is, the higher the randomness of generation will be."
+              "The smaller the value is, the higher the certainty of generation will be.",
+        zh_Hans="生成过程中核采样方法概率阈值。取值越大，生成的随机性越高；取值越小，生成的确定性越高。",
+    ),
+    type=ParameterType.FLOAT,
+    default=1.0,
+    min=0,
+    max=1,
+    precision=2,
+)
+
+# 未配置任何价格凭据时使用的默认价格
+_PRICE_CREDENTIAL_KEYS = ("input_price", "output_price", "unit", "currency")
+_DEFAULT_PRICING = PriceConfig(
+    input=Decimal(0),
+    output=Decimal(0),
+    unit=Decimal(0),
+    currency="USD",
+)
+
+
+def _pricing_from_credentials(credentials: dict) -> PriceConfig:
+    """按凭据生成价格配置；价格凭据均未配置时直接复用默认配置"""
+    if not any(key in credentials for key in _PRICE_CREDENTIAL_KEYS):
+        return _DEFAULT_PRICING
+    return PriceConfig(
+        input=Decimal(credentials.get("input_price", 0)),
+        output=Decimal(credentials.get("output_price", 0)),
+        unit=Decimal(credentials.get("unit", 0)),
+        currency=credentials.get("currency", "USD"),
+    )
+
+
+def _user_message_to_dict(message: PromptMessage) -> dict:
+    if not isinstance(message.content, list):
+        return {"role": "user", "content": message.content}
+
+    sub_messages = []
+    for message_content in message.content:
+        if isinstance(message_content, TextPromptMessageContent):
+            sub_message_dict = {
+                "type": "text",
+                "text": message_content.data
+            }
+            sub_messages.append(sub_message_dict)
+        elif isinstance(message_content, ImagePromptMessageContent):
+            sub_message_dict = {
+                "type": "image_url",
+                "image_url": {
+                    "url": message_content.data,
+                    "detail": message_content.detail.value,
+                }
+            }
+            sub_messages.append(sub_message_dict)
+        else:
+            # 暂时不会出现其他模态的数据
+            pass
+    return {"role": "user", "content": sub_messages}
+
+
+def _assistant_message_to_dict(message: PromptMessage) -> dict:
+    return {"role": "assistant", "content": message.content}
 
+
+def _system_message_to_dict(message: PromptMessage) -> dict:
+    if isinstance(message.content, list):
+        message.content = "".join(
+            c.data for c in message.content if isinstance(c, TextPromptMessageContent)
+        )
+    return {"role": "system", "content": message.content}
+
+
+def _tool_message_to_dict(message: PromptMessage) -> dict:
+    return {"role": "function", "content": message.content, "name": message.tool_call_id}
+
+
+# 按消息类型直接查找转换函数，避免逐个 isinstance 判断
+_MESSAGE_CONVERTERS = {
+    UserPromptMessage: _user_message_to_dict,
+    AssistantPromptMessage: _assistant_message_to_dict,
+    SystemPromptMessage: _system_message_to_dict,
+    ToolPromptMessage: _tool_message_to_dict,
+}
+
+
+def _convert_prompt_message_to_dict(message: PromptMessage) -> dict:
+    converter = _MESSAGE_CONVERTERS.get(type(message))
+    if converter is None:
+        # 子类消息退回 isinstance 判断
+        for message_type, candidate in _MESSAGE_CONVERTERS.items():
+            if isinstance(message, message_type):
+                converter = candidate
+                break
+        else:
+            raise ValueError(f"Got unknown type {message}")
+
+    message_dict = converter(message)
     if message.name:
         message_dict['name'] = message.name
     return message_dict
@@ -195,43 +308,11 @@ class VolNetworkLargeLanguageModel(LargeLanguageModel, ABC):
                 ModelPropertyKey.MODE: credentials.get("mode"),
             },
             parameter_rules=[
-                ParameterRule(
-                    name=DefaultParameterName.TEMPERATURE.value,
-                    label=I18nObject(en_US="Temperature", zh_Hans="温度"),
-                    help=I18nObject(
-                        en_US="Kernel sampling threshold. Used to determine the randomness of the results."
-                              "The higher the value, the stronger the randomness."
-                              "The higher the possibility of getting different answers to the same question.",
-                        zh_Hans="核采样阈值。用于决定结果随机性，取值越高随机性越强即相同的问题得到的不同答案的可能性越高。",
-                    ),
-                    type=ParameterType.FLOAT,
-                    default=float(credentials.get("temperature", 0.7)),
-                    min=0,
-                    max=2,
-                    precision=2,
-                ),
-                ParameterRule(
-                    name=DefaultParameterName.TOP_P.value,
-                    label=I18nObject(en_US="Top P", zh_Hans="Top P"),
-                    help=I18nObject(
-                        en_US="The probability threshold of the nucleus sampling method during the generation process."
-                              "The larger the value is, the higher the randomness of generation will be."
-                              "The smaller the value is, the higher the certainty of generation will be.",
-                        zh_Hans="生成过程中核采样方法概率阈值。取值越大，生成的随机性越高；取值越小，生成的确定性越高。",
-                    ),
-                    type=ParameterType.FLOAT,
-                    default=float(credentials.get("top_p", 1)),
-                    min=0,
-                    max=1,
-                    precision=2,
-                ),
+                # 只有默认值随凭据变化，其余字段复用模块级模板
+                _TEMPERATURE_RULE.model_copy(update={"default": float(credentials.get("temperature", 0.7))}),
+                _TOP_P_RULE.model_copy(update={"default": float(credentials.get("top_p", 1))}),
             ],
-            pricing=PriceConfig(
-                input=Decimal(credentials.get("input_price", 0)),
-                output=Decimal(credentials.get("output_price", 0)),
-                unit=Decimal(credentials.get("unit", 0)),
-                currency=credentials.get("currency", "USD"),
-            ),
+            pricing=_pricing_from_credentials(credentials),
         )
 
         return entity
@@ -246,18 +327,20 @@ class VolNetworkLargeLanguageModel(LargeLanguageModel, ABC):
             stop: Optional[list[str]] = None,
             stream: bool = True,
             user: Optional[str] = None, ):
-        logger.info(f'Credential info: {credentials}')
+        if logger.isEnabledFor(logging.DEBUG):
+            # 不记录 api_key
+            logger.debug("Credential info: %s",
+                         {k: v for k, v in credentials.items() if k != 'openai_api_key'})
+        # 只读取 bot_id、reference，不修改调用方传入的凭据
         if 'bot_id' in credentials:
             model = credentials['bot_id']
-            credentials.pop('bot_id')
-        if 'reference' in credentials:
-            reference = credentials['reference']
-            credentials.pop('reference')
+        # 未配置 reference 时不输出引用
+        reference = credentials.get('reference')
 
-        credentials_kwargs = _to_credential_kwargs(credentials)
+        api_key, base_url, proxy_host = _client_key(credentials)
 
-        logger.info(f'credentials_kwargs: {credentials_kwargs}')
-        client = OpenAI(**credentials_kwargs)
+        logger.debug("base_url: %s, proxy: %s", base_url, proxy_host)
+        client = _get_client(api_key, base_url, proxy_host)
 
         extra_model_kwargs = {}
         if stop:
@@ -281,7 +364,7 @@ class VolNetworkLargeLanguageModel(LargeLanguageModel, ABC):
                 model, credentials, response, prompt_messages, reference
             )
         return self._handle_chat_generate_response(
-            model, credentials, response, prompt_messages, reference
+            model, credentials, response, prompt_messages
         )
 
     def _handle_chat_generate_response(
@@ -314,7 +397,8 @@ class VolNetworkLargeLanguageModel(LargeLanguageModel, ABC):
 
     def _handle_chat_generate_stream_response(self, model, credentials, response, prompt_messages, reference):
         logger.info(f'_handle_chat_generate_stream_response start')
-        full_assistant_content = ""
+        # 完整回复按片段收集，结束时再拼接，避免每个 chunk 都复制整段字符串
+        full_assistant_content_chunks: list[str] = []
         # delta_assistant_message_function_call_storage: ChoiceDeltaFunctionCall = None
         prompt_token = 0
         completion_token = 0
@@ -329,6 +413,16 @@ class VolNetworkLargeLanguageModel(LargeLanguageModel, ABC):
         )
 
         is_reasoning_started = False
+        # 引用输出方式在整个流中不变，提前换算：1 输出完整引用，2 只输出引用数量，0 不输出
+        ref_mode = 1 if reference == "1" else 2 if reference == "2" else 0
+        # 循环内使用局部变量，避免每个 chunk 重复查找方法和全局名称
+        wrap_thinking = self._wrap_thinking_by_reasoning_content
+        append_content = full_assistant_content_chunks.append
+        construct_message = AssistantPromptMessage.model_construct
+        construct_chunk = LLMResultChunk.model_construct
+        construct_chunk_delta = LLMResultChunkDelta.model_construct
+        # 流结束后只输出一条汇总日志，不逐个 chunk 记录
+        chunk_count = 0
 
         for chunk in response:
             if len(chunk.choices) == 0:
@@ -337,21 +431,15 @@ class VolNetworkLargeLanguageModel(LargeLanguageModel, ABC):
                     completion_token = chunk.usage.completion_token
                 continue
             # print(chunk)
-            if hasattr(chunk, 'references') and reference != 0:
-                references = chunk.references
-                for ref in references:
-                    ref.pop('extra')
-                    site_name = ref['site_name']
-                    if len(site_name) > 4 and "搜索引擎-" in site_name:
-                        site_name = site_name.replace("搜索引擎-", "")
-                        ref['site_name'] = site_name
-
-                if reference == "1":
-                    delta_content = ("@@@" + json.dumps(references, ensure_ascii=False) + "@@@")
-                elif reference == "2":
-                    delta_content = ("@@@" + str(len(references)) + "@@@")
+            references = getattr(chunk, 'references', None)
+            if ref_mode and references is not None:
+                if ref_mode == 1:
+                    for ref in references:
+                        ref.pop('extra', None)
+                        ref['site_name'] = ref['site_name'].removeprefix("搜索引擎-")
+                    delta_content = "@@@" + _REFERENCE_ENCODER.encode(references) + "@@@"
                 else:
-                    delta_content = None
+                    delta_content = ("@@@" + str(len(references)) + "@@@")
 
                 delta = chunk.choices[0]
                 assistant_prompt_message = AssistantPromptMessage(
@@ -371,8 +459,11 @@ class VolNetworkLargeLanguageModel(LargeLanguageModel, ABC):
 
             delta = chunk.choices[0]
             # print(delta.delta)
+            # delta 的字段每个 chunk 只读取一次
+            choice_delta = delta.delta
+            content = choice_delta.content
             delta_content, is_reasoning_started = (
-                self._wrap_thinking_by_reasoning_content(delta.delta, is_reasoning_started)
+                wrap_thinking(choice_delta, is_reasoning_started)
             )
 
             # print(delta_content)
@@ -380,15 +471,17 @@ class VolNetworkLargeLanguageModel(LargeLanguageModel, ABC):
 
             if (
                     not has_finish_reason
-                    and (delta.delta.content is None or delta.delta.content == "")
-                    and delta.delta.function_call is None
+                    and not content
+                    and choice_delta.function_call is None
                     and delta_content == ""
             ):
                 continue
 
-            assistant_prompt_message = AssistantPromptMessage(content=delta_content or "", tool_calls=[])
-            logger.info(f"{assistant_prompt_message}")
-            full_assistant_content += delta.delta.content or ""
+            # 逐 token 的消息字段都是已知类型，用 model_construct 跳过 pydantic 校验
+            assistant_prompt_message = construct_message(content=delta_content or "", tool_calls=[])
+            chunk_count += 1
+            if content:
+                append_content(content)
 
             if has_finish_reason:
                 final_chunk = LLMResultChunk(
@@ -402,11 +495,13 @@ class VolNetworkLargeLanguageModel(LargeLanguageModel, ABC):
                     )
                 )
             else:
-                yield LLMResultChunk(
+                # model_construct 不会执行 prompt_messages 校验器（该校验器总是置为 []），
+                # 这里显式传空列表，避免每个 token 都序列化完整的提示词历史
+                yield construct_chunk(
                     model=chunk.model,
-                    prompt_messages=prompt_messages,
+                    prompt_messages=[],
                     system_fingerprint=chunk.system_fingerprint,
-                    delta=LLMResultChunkDelta(
+                    delta=construct_chunk_delta(
                         index=delta.index,
                         message=assistant_prompt_message,
                     )
@@ -414,12 +509,16 @@ class VolNetworkLargeLanguageModel(LargeLanguageModel, ABC):
         if not prompt_token:
             prompt_token = self.get_num_tokens(model, credentials, prompt_messages, [])
         if not completion_token:
+            full_assistant_content = "".join(full_assistant_content_chunks)
             final_assistant_prompt_message = AssistantPromptMessage(content=full_assistant_content, tool_calls=[])
             completion_token = self.get_num_tokens(model, credentials, [final_assistant_prompt_message], [])
 
         usage = self._calc_response_usage(model, credentials, prompt_token, completion_token)
         final_chunk.delta.usage = usage
-        logger.info(f"other: {final_chunk.delta}")
+        logger.info(
+            "stream done model=%s chunks=%d prompt_tokens=%d completion_tokens=%d finish_reason=%s",
+            model, chunk_count, prompt_token, completion_token, final_chunk.delta.finish_reason
+        )
         yield final_chunk
 
     def _invoke_error_mapping(self):
@@ -435,15 +534,12 @@ class VolNetworkLargeLanguageModel(LargeLanguageModel, ABC):
         :return: tuple of (processed_content, is_reasoning)
         """
 
-        if delta.content:
-            content = delta.content
-        else:
-            content = ""
+        reasoning_content = getattr(delta, 'reasoning_content', None)
+        # 绝大多数 chunk 既无推理内容也不在推理中，直接返回正文
+        if not reasoning_content and not is_reasoning:
+            return delta.content or "", False
 
-        if hasattr(delta, 'reasoning_content'):
-            reasoning_content = delta.reasoning_content
-        else:
-            reasoning_content = None
+        content = delta.content or ""
 
         if reasoning_content:
             if not is_reasoning: